@@ -44,54 +44,68 @@ class Model(object):
             self.use_configuration(self.configuration.config_dict)
 
         if (self.rank == 0):
+            self.read_tables()
 
-            if (self.eos_type == 'MANCHA'):            
+    def read_tables(self):
+        """
+        Read the equation of state and the kappa5000 tables
 
-                self.logger.info('Reading EOS - MANCHA')
+        Parameters
+        ----------
+        None
 
-                filename = os.path.join(os.path.dirname(__file__), 'data/eos_mancha.h5')
-                f = h5py.File(filename, 'r')
-                self.T_eos = np.log10(f['T'][:])
-                self.P_eos = np.log10(f['P'][:])
-                self.Pe_eos = np.log10(f['Pel'][:])
-                f.close()
-                
-                self.logger.info('Reading kappa5000 - MANCHA')
-                self.T_kappa5 = np.array([3.32, 3.34, 3.36, 3.38, 3.40, 3.42, 3.44, 3.46, 3.48, 3.50, 
-                    3.52, 3.54, 3.56, 3.58, 3.60, 3.62, 3.64, 3.66, 3.68, 3.70, 
-                    3.73, 3.76, 3.79, 3.82, 3.85, 3.88, 3.91, 3.94, 3.97, 4.00, 
-                    4.05, 4.10, 4.15, 4.20, 4.25, 4.30, 4.35, 4.40, 4.45, 4.50, 
-                    4.55, 4.60, 4.65, 4.70, 4.75, 4.80, 4.85, 4.90, 4.95, 5.00, 
-                    5.05, 5.10, 5.15, 5.20, 5.25, 5.30 ])
+        Returns
+        -------
+        None
+        """
 
-                self.P_kappa5 = np.array([-2., -1.5, -1., -.5, 0., .5, 1., 1.5, 2., 2.5, 3., 3.5, 4., 4.5, 5., 5.5, 6. ,6.5, 7., 7.5, 8. ])
+        if (self.eos_type == 'MANCHA'):            
 
-                self.kappa = np.zeros((56,21))
+            self.logger.info('Reading EOS - MANCHA')
 
-                filename = os.path.join(os.path.dirname(__file__), 'data/kappa5000_mancha.dat')
-                f = open(filename, 'r')
-                        
-                for it in range(56):
-                    for ip in range(21):
-                        self.kappa[it,ip] = float(f.readline().split()[-1])
+            filename = os.path.join(os.path.dirname(__file__), 'data/eos_mancha.h5')
+            f = h5py.File(filename, 'r')
+            self.T_eos = np.log10(f['T'][:])
+            self.P_eos = np.log10(f['P'][:])
+            self.Pe_eos = np.log10(f['Pel'][:])
+            f.close()
+            
+            self.logger.info('Reading kappa5000 - MANCHA')
+            self.T_kappa5 = np.array([3.32, 3.34, 3.36, 3.38, 3.40, 3.42, 3.44, 3.46, 3.48, 3.50, 
+                3.52, 3.54, 3.56, 3.58, 3.60, 3.62, 3.64, 3.66, 3.68, 3.70, 
+                3.73, 3.76, 3.79, 3.82, 3.85, 3.88, 3.91, 3.94, 3.97, 4.00, 
+                4.05, 4.10, 4.15, 4.20, 4.25, 4.30, 4.35, 4.40, 4.45, 4.50, 
+                4.55, 4.60, 4.65, 4.70, 4.75, 4.80, 4.85, 4.90, 4.95, 5.00, 
+                5.05, 5.10, 5.15, 5.20, 5.25, 5.30 ])
 
-                f.close()
+            self.P_kappa5 = np.array([-2., -1.5, -1., -.5, 0., .5, 1., 1.5, 2., 2.5, 3., 3.5, 4., 4.5, 5., 5.5, 6. ,6.5, 7., 7.5, 8. ])
 
-            else:
+            self.kappa = np.zeros((56,21))
+
+            filename = os.path.join(os.path.dirname(__file__), 'data/kappa5000_mancha.dat')
+            f = open(filename, 'r')
+                    
+            for it in range(56):
+                for ip in range(21):
+                    self.kappa[it,ip] = float(f.readline().split()[-1])
+
+            f.close()
+
+        else:
+
+            self.logger.info('Reading EOS and kappa5000 - SIR')
+
+            filename = os.path.join(os.path.dirname(__file__), 'data/kappa5000_eos_sir.h5')
+            f = h5py.File(filename, 'r')
+            self.T_eos = np.log10(f['T'][:])
+            self.P_eos = np.log10(f['P'][:])
+            self.Pe_eos = np.log10(f['Pe'][:])
+                            
+            self.T_kappa5 = np.log10(f['T'][:])
+            self.P_kappa5 = np.log10(f['P'][:])
+            self.kappa = f['kappa5000'][:]
+            f.close()
 
-                self.logger.info('Reading EOS and kappa5000 - SIR')
-
-                filename = os.path.join(os.path.dirname(__file__), 'data/kappa5000_eos_sir.h5')
-                f = h5py.File(filename, 'r')
-                self.T_eos = np.log10(f['T'][:])
-                self.P_eos = np.log10(f['P'][:])
-                self.Pe_eos = np.log10(f['Pe'][:])
-                                
-                self.T_kappa5 = np.log10(f['T'][:])
-                self.P_kappa5 = np.log10(f['P'][:])
-                self.kappa = f['kappa5000'][:]
-                f.close()
-        
     def __getstate__(self):
         d = self.__dict__.copy()
         if 'logger' in d:
@@ -371,6 +385,9 @@ class Model(object):
         self.n_lambda_sir = n_lambda
         self.lambda_zeropoint = 1e3*wvl[0]
 
+        # Same wavelength grid that SIR builds in init and returns as the first row of the Stokes parameters
+        self.lambda_axis = np.linspace(lambda0, lambda1, n_lambda)
+
     def intpltau(self, newtau, oldtau, var):
         fX = interpolate.interp1d(oldtau, var, bounds_error=False, fill_value="extrapolate")
         return fX(newtau)
@@ -461,70 +478,87 @@ class Model(object):
 
     def synth2d(self, T, P, rho, vz, Bx, By, Bz, tau500, Ne, interpolate_model=False):
 
-        n = T.shape[1]
+        n = T.shape[0]
         Pe = Ne * scipy.constants.k * 1e7 * T # convert SI to cgs units - kg to g and m to cm2
         log_T = np.log10(T)
         log_P = np.log10(P)
         log_tau = np.log10(tau500)
+        uT = np.zeros(T.shape[1])
 
         stokes_out = np.zeros((5,n,self.n_lambda_sir))
 
         if (interpolate_model): 
             model_out = np.zeros((7,n,self.n_tau)) 
 
-        for loop in range(n):
+        # Optical depth and electron pressure are interpolated for all pixels of the batch at once
+        if (interpolate_model or self.tau_fine != 0.0):
+            it0 = np.searchsorted(self.T_kappa5, log_T) - 1
+            it1 = it0 + 1
+            ip0 = np.searchsorted(self.P_kappa5, log_P) - 1
+            ip1 = ip0 + 1
 
-            if interpolate_model:
-                it0 = np.searchsorted(self.T_kappa5, log_T) - 1
-                it1 = it0 + 1
-                ip0 = np.searchsorted(self.P_kappa5, log_P) - 1
-                ip1 = ip0 + 1
+            kappa = self.kappa[it0,ip0] * (self.T_kappa5[it1] - log_T) * (self.P_kappa5[ip1] - log_P) + \
+                    self.kappa[it1,ip0] * (log_T - self.T_kappa5[it0]) * (self.P_kappa5[ip1] - log_P) + \
+                    self.kappa[it0,ip1] * (self.T_kappa5[it1] - log_T) * (log_P - self.P_kappa5[ip0]) + \
+                    self.kappa[it1,ip1] * (log_T - self.T_kappa5[it0]) * (log_P - self.P_kappa5[ip0])
 
-                kappa = self.kappa[it0,ip0] * (self.T_kappa5[it1] - log_T) * (self.P_kappa5[ip1] - log_P) + \
-                        self.kappa[it1,ip0] * (log_T - self.T_kappa5[it0]) * (self.P_kappa5[ip1] - log_P) + \
-                        self.kappa[it0,ip1] * (self.T_kappa5[it1] - log_T) * (log_P - self.P_kappa5[ip0]) + \
-                        self.kappa[it1,ip1] * (log_T - self.T_kappa5[it0]) * (log_P - self.P_kappa5[ip0])
-    
-                kappa /= ((self.T_kappa5[it1] - self.T_kappa5[it0]) * (self.P_kappa5[ip1] - self.P_kappa5[ip0]))
-    
-                if (self.eos_type == 'MANCHA'):
-                    chi = (kappa * rho[:,loop])[::-1]
-                else:
-                    chi = kappa[::-1]
-             
-                tau = integ.cumtrapz(chi, x=self.deltaz)
-                ltau = np.log10(np.insert(tau, 0, 0.5*tau[0]))[::-1]
-
-                ind = np.where(ltau < 2.0)[0]
-
-                # Get electron pressure
-                it0 = np.searchsorted(self.T_eos, log_T) - 1
-                it1 = it0 + 1
-                ip0 = np.searchsorted(self.P_eos, log_P) - 1
-                ip1 = ip0 + 1
-
-                if (self.eos_type == 'MANCHA'):
-                    log_Pe = self.Pe_eos[ip0,it0] * (self.T_eos[it1] - log_T) * (self.P_eos[ip1] - log_P) + \
-                            self.Pe_eos[ip1,it0] * (log_T - self.T_eos[it0]) * (self.P_eos[ip1] - log_P) + \
-                            self.Pe_eos[ip0,it1] * (self.T_eos[it1] - log_T) * (log_P - self.P_eos[ip0]) + \
-                            self.Pe_eos[ip1,it1] * (log_T - self.T_eos[it0]) * (log_P - self.P_eos[ip0])
-                else:
-                    log_Pe = self.Pe_eos[it0,ip0] * (self.T_eos[it1] - log_T) * (self.P_eos[ip1] - log_P) + \
-                            self.Pe_eos[it1,ip0] * (log_T - self.T_eos[it0]) * (self.P_eos[ip1] - log_P) + \
-                            self.Pe_eos[it0,ip1] * (self.T_eos[it1] - log_T) * (log_P - self.P_eos[ip0]) + \
-                            self.Pe_eos[it1,ip1] * (log_T - self.T_eos[it0]) * (log_P - self.P_eos[ip0])
-
-                log_Pe /= ((self.T_eos[it1] - self.T_eos[it0]) * (self.P_eos[ip1] - self.P_eos[ip0]))
-
-            if (self.tau_fine != 0.0):
-                taufino = np.arange(np.min(ltau[ind]), np.max(ltau[ind]), self.tau_fine)[::-1]
-                stokes_out[:,loop,:], error = sir_code.synth(1, self.n_lambda_sir, taufino, self.intpltau(taufino, ltau[ind], T[ind,loop]),
-                    10**self.intpltau(taufino, ltau[ind], log_Pe[ind]), self.intpltau(taufino, ltau[ind], self.zeros[ind]), 
-                    self.intpltau(taufino, ltau[ind], self.vz_multiplier*vz[ind,loop]), self.intpltau(taufino, ltau[ind], self.bx_multiplier*Bx[ind,loop]),
-                    self.intpltau(taufino, ltau[ind], self.by_multiplier*By[ind,loop]), self.intpltau(taufino, ltau[ind], self.bz_multiplier*Bz[ind,loop]), self.macroturbulence)
+            kappa /= ((self.T_kappa5[it1] - self.T_kappa5[it0]) * (self.P_kappa5[ip1] - self.P_kappa5[ip0]))
+
+            if (self.eos_type == 'MANCHA'):
+                chi = (kappa * rho)[:,::-1]
+            else:
+                chi = kappa[:,::-1]
+
+            tau = integ.cumtrapz(chi, x=self.deltaz, axis=-1)
+            ltau = np.log10(np.concatenate([0.5*tau[:,0:1], tau], axis=1))[:,::-1]
+
+            # Get electron pressure
+            it0 = np.searchsorted(self.T_eos, log_T) - 1
+            it1 = it0 + 1
+            ip0 = np.searchsorted(self.P_eos, log_P) - 1
+            ip1 = ip0 + 1
+
+            if (self.eos_type == 'MANCHA'):
+                log_Pe = self.Pe_eos[ip0,it0] * (self.T_eos[it1] - log_T) * (self.P_eos[ip1] - log_P) + \
+                        self.Pe_eos[ip1,it0] * (log_T - self.T_eos[it0]) * (self.P_eos[ip1] - log_P) + \
+                        self.Pe_eos[ip0,it1] * (self.T_eos[it1] - log_T) * (log_P - self.P_eos[ip0]) + \
+                        self.Pe_eos[ip1,it1] * (log_T - self.T_eos[it0]) * (log_P - self.P_eos[ip0])
+            else:
+                log_Pe = self.Pe_eos[it0,ip0] * (self.T_eos[it1] - log_T) * (self.P_eos[ip1] - log_P) + \
+                        self.Pe_eos[it1,ip0] * (log_T - self.T_eos[it0]) * (self.P_eos[ip1] - log_P) + \
+                        self.Pe_eos[it0,ip1] * (self.T_eos[it1] - log_T) * (log_P - self.P_eos[ip0]) + \
+                        self.Pe_eos[it1,ip1] * (log_T - self.T_eos[it0]) * (log_P - self.P_eos[ip0])
+
+            log_Pe /= ((self.T_eos[it1] - self.T_eos[it0]) * (self.P_eos[ip1] - self.P_eos[ip0]))
+
+        # Bind everything used inside the pixel loop to locals and scale the velocity and field once per batch
+        synth = sir_code.synth
+        intpltau = self.intpltau
+        n_lambda_sir = self.n_lambda_sir
+        macroturbulence = self.macroturbulence
+        tau_fine = self.tau_fine
+        vz = self.vz_multiplier * vz
+        Bx = self.bx_multiplier * Bx
+        By = self.by_multiplier * By
+        Bz = self.bz_multiplier * Bz
+
+        if (interpolate_model):
+            interpolated_tau = self.interpolated_tau
+            deltaz = self.deltaz[::-1]
+
+        for loop in range(n):
+
+            if (tau_fine != 0.0):
+                ind = np.where(ltau[loop] < 2.0)[0]
+                lt = ltau[loop,ind]
+                taufino = np.arange(np.min(lt), np.max(lt), tau_fine)[::-1]
+                stokes_out[:,loop,:], error = synth(1, n_lambda_sir, taufino, intpltau(taufino, lt, T[loop,ind]),
+                    10**intpltau(taufino, lt, log_Pe[loop,ind]), intpltau(taufino, lt, uT[ind]), 
+                    intpltau(taufino, lt, vz[loop,ind]), intpltau(taufino, lt, Bx[loop,ind]),
+                    intpltau(taufino, lt, By[loop,ind]), intpltau(taufino, lt, Bz[loop,ind]), macroturbulence)
             else:
-                stokes_out[:,loop,:], error = sir_code.synth(1, self.n_lambda_sir, log_tau[:,loop], T[:,loop], Pe[:, loop], self.zeros[0:self.nz], 
-                    self.vz_multiplier*vz[:,loop], self.bx_multiplier*Bx[:,loop], self.by_multiplier*By[:,loop], self.bz_multiplier*Bz[:,loop], self.macroturbulence)
+                stokes_out[:,loop,:], error = synth(1, n_lambda_sir, log_tau[loop], T[loop], Pe[loop], uT, 
+                    vz[loop], Bx[loop], By[loop], Bz[loop], macroturbulence)
 
             if (error != 0):
                 logging.warning('synth returned error: %d'%(error))
@@ -533,13 +567,14 @@ class Model(object):
             # We want to interpolate the model to certain isotau surfaces
             if (interpolate_model):
 
-                model_out[0,loop,:] = self.intpltau(self.interpolated_tau, ltau[::-1], self.deltaz[::-1])
-                model_out[1,loop,:] = self.intpltau(self.interpolated_tau, ltau[::-1], T[::-1,loop])
-                model_out[2,loop,:] = np.exp(self.intpltau(self.interpolated_tau, ltau[::-1], np.log(P[::-1,loop])))
-                model_out[3,loop,:] = self.intpltau(self.interpolated_tau, ltau[::-1], self.vz_multiplier * vz[::-1,loop])
-                model_out[4,loop,:] = self.intpltau(self.interpolated_tau, ltau[::-1], self.bx_multiplier * Bx[::-1,loop])
-                model_out[5,loop,:] = self.intpltau(self.interpolated_tau, ltau[::-1], self.by_multiplier * By[::-1,loop])
-                model_out[6,loop,:] = self.intpltau(self.interpolated_tau, ltau[::-1], self.bz_multiplier * Bz[::-1,loop])
+                lt = ltau[loop,::-1]
+                model_out[0,loop,:] = intpltau(interpolated_tau, lt, deltaz)
+                model_out[1,loop,:] = intpltau(interpolated_tau, lt, T[loop,::-1])
+                model_out[2,loop,:] = np.exp(intpltau(interpolated_tau, lt, np.log(P[loop,::-1])))
+                model_out[3,loop,:] = intpltau(interpolated_tau, lt, vz[loop,::-1])
+                model_out[4,loop,:] = intpltau(interpolated_tau, lt, Bx[loop,::-1])
+                model_out[5,loop,:] = intpltau(interpolated_tau, lt, By[loop,::-1])
+                model_out[6,loop,:] = intpltau(interpolated_tau, lt, Bz[loop,::-1])
 
         if (interpolate_model):
             return stokes_out, model_out
@@ -1,4 +1,5 @@
 import numpy as np
+import copy
 try:
     from mpi4py import MPI
     _mpi_available = True
@@ -6,16 +7,23 @@ except:
     _mpi_available = False
 
 from enum import IntEnum
+from concurrent.futures import ThreadPoolExecutor
 import h5py
 from tqdm import tqdm, trange
 import logging
+
+# Collective writes from all ranks need h5py built against a parallel HDF5
+_parallel_hdf5 = h5py.get_config().mpi
 # from ipdb import set_trace as stop
 
+# Attribute of the Iterator holding each MURAM cube and the attribute of the model with its file
+_muram_fields = [('T', 'T_file'), ('P', 'P_file'), ('rho', 'rho_file'), ('vz', 'vz_file'), ('Bx', 'Bx_file'), 
+    ('By', 'By_file'), ('Bz', 'Bz_file'), ('tau500', 'tau_file'), ('ne', 'ne_file')]
+
 class tags(IntEnum):
-    READY = 0
-    DONE = 1
     EXIT = 2
-    START = 3
+    MODEL = 4
+    STOKES = 5
 
 class Iterator(object):
     def __init__(self, use_mpi=False, batch=1, n_batches=None):
@@ -30,6 +38,7 @@ class Iterator(object):
             self.size = self.comm.size        # total number of processes
             self.rank = self.comm.rank        # rank of this process
             self.status = MPI.Status()   # get MPI status object            
+            self.node_comm = self.comm.Split_type(MPI.COMM_TYPE_SHARED)   # ranks sharing memory on this node
 
             if (self.size == 1):
                 raise Exception("You do not have agents available or you need to start the code with mpiexec.")
@@ -63,17 +72,18 @@ class Iterator(object):
 
                 self.logger.info('Broadcasting models to all agents')
 
-                self.comm.Barrier()
-                self.comm.bcast(self.model, root=0)                
-                self.comm.Barrier()                
-            else:
-                model = None
+                # Only the settings are broadcast. The agents do not need the parsed configuration,
+                # and they read the EOS and kappa5000 tables from the package data themselves
+                settings = copy.copy(model)
+                for name in ['configuration', 'T_eos', 'P_eos', 'Pe_eos', 'T_kappa5', 'P_kappa5', 'kappa']:
+                    vars(settings).pop(name, None)
 
-                self.comm.Barrier()
-                self.model = self.comm.bcast(model, root=0)
-                self.comm.Barrier()
+                self.comm.bcast(settings, root=0)
+            else:
+                self.model = self.comm.bcast(None, root=0)
 
                 # self.model.init_sir_agents()
+                self.model.read_tables()
                 self.model.init_sir(self.model.spectral_regions_dict)
                             
         else:
@@ -82,6 +92,191 @@ class Iterator(object):
         if (self.rank == 0):
             self.logger.info('All agents ready')
 
+    def _load_muram_field(self, filename):
+        """
+        Map one MURAM cube from disk without reading it into memory
+
+        Parameters
+        ----------
+        filename : str
+            File with the cube in float32
+
+        Returns
+        -------
+        array
+            Cube with axes ordered as (y, x, z), so that the depth stratification of each pixel is contiguous
+        """
+        cube = np.memmap(filename, dtype=np.float32, mode='r', shape=self.model.model_shape)
+        return np.ascontiguousarray(cube.transpose(self.model.ay, self.model.ax, self.model.az))
+
+    def _load_muram_field_shared(self, filename):
+        """
+        Read one MURAM cube into a shared memory window, so that all ranks on a node use a single copy.
+        The first rank of the node reads the cube and the others map the same memory.
+
+        Parameters
+        ----------
+        filename : str
+            File with the cube in float32
+
+        Returns
+        -------
+        array
+            Cube with axes ordered as (y, x, z)
+        """
+        shape = (self.model.model_shape[self.model.ay], self.model.model_shape[self.model.ax], self.model.model_shape[self.model.az])
+        itemsize = np.dtype(np.float32).itemsize
+        nbytes = int(np.prod(shape)) * itemsize if (self.node_comm.rank == 0) else 0
+
+        win = MPI.Win.Allocate_shared(nbytes, itemsize, comm=self.node_comm)
+        self.windows.append(win)
+        buf, itemsize = win.Shared_query(0)
+        cube = np.ndarray(buffer=buf, dtype=np.float32, shape=shape)
+
+        if (self.node_comm.rank == 0):
+            cube[:] = np.memmap(filename, dtype=np.float32, mode='r', shape=self.model.model_shape).transpose(self.model.ay, self.model.ax, self.model.az)
+        self.node_comm.Barrier()
+
+        return cube
+
+    def _free_shared_fields(self):
+        """
+        Drop the cubes read with _load_muram_field_shared and free their shared memory windows
+
+        Parameters
+        ----------
+        None
+
+        Returns
+        -------
+        None
+        """
+        for name, f in _muram_fields:
+            if (hasattr(self, name)):
+                delattr(self, name)
+        for win in self.windows:
+            win.Free()
+        self.windows = []
+
+    def _load_muram(self, shared=False):
+        """
+        Load the nine MURAM cubes into T, P, rho, vz, Bx, By, Bz, tau500 and ne. vz always holds
+        the velocity, also when the cube stores the momentum.
+
+        Parameters
+        ----------
+        shared : bool
+            Read the cubes into shared memory windows of the node with _load_muram_field_shared
+
+        Returns
+        -------
+        None
+        """
+        if (shared):
+            # Allocating the windows is collective on the node, so the cubes are loaded one after the other
+            cubes = [self._load_muram_field_shared(getattr(self.model, f)) for name, f in _muram_fields]
+        else:
+            # The reads and transposes release the GIL, so the cubes are loaded concurrently
+            with ThreadPoolExecutor(max_workers=len(_muram_fields)) as executor:
+                cubes = list(executor.map(self._load_muram_field, [getattr(self.model, f) for name, f in _muram_fields]))
+
+        for (name, f), cube in zip(_muram_fields, cubes):
+            setattr(self, name, cube)
+
+        # If the cube holds the momentum, the velocity is computed once for the whole cube,
+        # in place in the shared window
+        if (self.model.vz_type != 'vz'):
+            if (not shared):
+                self.vz = self.vz / self.rho
+            elif (self.node_comm.rank == 0):
+                np.divide(self.vz, self.rho, out=self.vz)
+
+        if (shared):
+            self.node_comm.Barrier()
+            for name, f in _muram_fields:
+                getattr(self, name).flags.writeable = False
+
+    def load_tile(self, iy0, iy1, ix0, ix1):
+        """
+        Extract a tile of pixels from the MURAM cubes in float64
+
+        Parameters
+        ----------
+        iy0, iy1, ix0, ix1 : int
+            Limits of the tile along each axis
+
+        Returns
+        -------
+        list
+            T, P, rho, vz, Bx, By, Bz, tau500 and ne in the tile, with axes ordered as (y, x, z)
+        """
+        return [f[iy0:iy1,ix0:ix1].astype('float64') for f in [self.T, self.P, self.rho, self.vz, self.Bx, self.By, self.Bz, self.tau500, self.ne]]
+
+    def chunk_shape(self, n_ranks=1):
+        """
+        Chunk shape of the Stokes datasets. Chunks hold about 1 MiB of spectra, but are made smaller
+        if needed to have enough chunks to share among all ranks.
+
+        Parameters
+        ----------
+        n_ranks : int
+            Number of ranks doing the synthesis
+
+        Returns
+        -------
+        tuple
+            Chunk shape
+        """
+        side = int(np.sqrt((1 << 20) / (4 * self.model.n_lambda_sir)))
+        chunk_y = int(max(1, min(64, side, self.model.ny // (4 * np.sqrt(n_ranks)))))
+        chunk_x = int(max(1, min(64, side, self.model.nx // (4 * np.sqrt(n_ranks)))))
+
+        return (chunk_y, chunk_x, self.model.n_lambda_sir)
+
+    def open_stokes_file(self, chunks, **kwargs):
+        """
+        Open the output Stokes file with a chunk cache large enough to hold a full row of chunks
+
+        Parameters
+        ----------
+        chunks : tuple
+            Chunk shape of the Stokes datasets
+        **kwargs : dict
+            Additional arguments for h5py.File, like the MPI-IO driver
+
+        Returns
+        -------
+        h5py.File
+            Output Stokes file
+        """
+        chunk_bytes = chunks[0] * chunks[1] * chunks[2] * 4
+        rdcc_nbytes = max(chunk_bytes * (self.model.nx // chunks[1] + 1) * 4, 256 << 20)
+
+        return h5py.File(self.model.output_file, 'w', rdcc_nbytes=rdcc_nbytes, rdcc_nslots=100003, rdcc_w0=0.75, **kwargs)
+
+    def create_stokes_datasets(self, chunks):
+        """
+        Create the Stokes datasets in the output file. The smooth spectra compress well
+        once the bytes are shuffled.
+
+        Parameters
+        ----------
+        chunks : tuple
+            Chunk shape of the Stokes datasets
+
+        Returns
+        -------
+        None
+        """
+        shape = (self.model.ny, self.model.nx, self.model.n_lambda_sir)
+        self.stokesI_db = self.f_stokes_out.create_dataset('I', shape, dtype=np.float32, chunks=chunks, compression='gzip', compression_opts=1, shuffle=True)
+        self.stokesQ_db = self.f_stokes_out.create_dataset('Q', shape, dtype=np.float32, chunks=chunks, compression='gzip', compression_opts=1, shuffle=True)
+        self.stokesU_db = self.f_stokes_out.create_dataset('U', shape, dtype=np.float32, chunks=chunks, compression='gzip', compression_opts=1, shuffle=True)
+        self.stokesV_db = self.f_stokes_out.create_dataset('V', shape, dtype=np.float32, chunks=chunks, compression='gzip', compression_opts=1, shuffle=True)
+        # The wavelength axis is known from the spectral regions, so it is written up front
+        self.lambda_db = self.f_stokes_out.create_dataset('lambda', data=self.model.lambda_axis, dtype=np.float32)
+        self.f_stokes_out.attrs.create("lambda_zeropoint", self.model.lambda_zeropoint)
+
     def nonmpi_work(self, rangex, rangey):
         """
         Do the synthesis/inversion for all pixels in the models
@@ -97,89 +292,206 @@ class Iterator(object):
         """
 
         if (self.model.atmosphere_type == 'MURAM'):
-            tmp = np.fromfile(self.model.T_file, dtype = np.float32)
-            tmpa = tmp.reshape(self.model.model_shape)
-            self.T = tmpa.transpose(self.model.az, self.model.ay, self.model.ax)
+            self._load_muram()
 
-            tmp = np.fromfile(self.model.P_file, dtype = np.float32)
-            tmpa = tmp.reshape(self.model.model_shape)
-            self.P = tmpa.transpose(self.model.az, self.model.ay, self.model.ax)
+            self.n_pixels = self.model.nx * self.model.ny
 
-            tmp = np.fromfile(self.model.rho_file, dtype = np.float32)
-            tmpa = tmp.reshape(self.model.model_shape)
-            self.rho = tmpa.transpose(self.model.az, self.model.ay, self.model.ax)
+        chunks = self.chunk_shape()
+        self.f_stokes_out = self.open_stokes_file(chunks)
+        self.create_stokes_datasets(chunks)
 
-            tmp = np.fromfile(self.model.vz_file, dtype = np.float32)
-            tmpa = tmp.reshape(self.model.model_shape)
-            self.vz = tmpa.transpose(self.model.az, self.model.ay, self.model.ax)
+        # The output files are closed even if the synthesis fails, so that the rows already written are kept
+        interpolate_model = False
+        try:
+            # If we want to extract a model sampled at selected taus
+            if (self.model.interpolated_model_filename is not None):
+                self.f_model_out = h5py.File(self.model.interpolated_model_filename, 'w')
+                self.model_db = self.f_model_out.create_dataset('model', (self.model.ny, self.model.nx, 7, self.model.n_tau), dtype=np.float32)
+                interpolate_model = True
+
+
+            # Accumulate a full row of chunks in memory so that each HDF5 chunk is written only once
+            n_rows = chunks[0]
+            bufI = np.empty((n_rows, self.model.nx, self.model.n_lambda_sir), dtype=np.float32)
+            bufQ = np.empty((n_rows, self.model.nx, self.model.n_lambda_sir), dtype=np.float32)
+            bufU = np.empty((n_rows, self.model.nx, self.model.n_lambda_sir), dtype=np.float32)
+            bufV = np.empty((n_rows, self.model.nx, self.model.n_lambda_sir), dtype=np.float32)
+            if (interpolate_model):
+                bufModel = np.empty((n_rows, self.model.nx, 7, self.model.n_tau), dtype=np.float32)
+
+            # Loop over tiles of pixels matching the HDF5 chunks, with a single progress bar counting pixels
+            pbar = tqdm(total=self.model.ny * self.model.nx, ncols=140, unit='px')
+            for iy0 in range(0, self.model.ny, n_rows):
+                iy1 = min(iy0 + n_rows, self.model.ny)
+                for ix0 in range(0, self.model.nx, chunks[1]):
+                    ix1 = min(ix0 + chunks[1], self.model.nx)
+
+                    ny_tile, nx_tile = iy1 - iy0, ix1 - ix0
+
+                    # The whole tile is synthesized as a single batch of pixels
+                    T, P, rho, vz, Bx, By, Bz, tau500, Ne = [f.reshape(ny_tile * nx_tile, -1) for f in self.load_tile(iy0, iy1, ix0, ix1)]
 
-            tmp = np.fromfile(self.model.Bx_file, dtype = np.float32)
-            tmpa = tmp.reshape(self.model.model_shape)
-            self.Bx = tmpa.transpose(self.model.az, self.model.ay, self.model.ax)
+                    if (interpolate_model):
+                        stokes, model = self.model.synth2d(T, P, rho, vz, Bx, By, Bz, tau500, Ne, interpolate_model=interpolate_model)
+                        bufModel[:ny_tile,ix0:ix1,:,:] = model.reshape(7, ny_tile, nx_tile, self.model.n_tau).transpose(1, 2, 0, 3)
+                    else:
+                        stokes = self.model.synth2d(T, P, rho, vz, Bx, By, Bz, tau500, Ne, interpolate_model=None)
+
+                    stokes = stokes.reshape(5, ny_tile, nx_tile, self.model.n_lambda_sir)
+                    bufI[:ny_tile,ix0:ix1,:] = stokes[1]
+                    bufQ[:ny_tile,ix0:ix1,:] = stokes[2]
+                    bufU[:ny_tile,ix0:ix1,:] = stokes[3]
+                    bufV[:ny_tile,ix0:ix1,:] = stokes[4]
+                    del stokes
+
+                    pbar.update(ny_tile * nx_tile)
+
+                # Flush the row of chunks once it is complete, straight from the buffers
+                rows = np.s_[:iy1-iy0]
+                self.stokesI_db.write_direct(bufI, rows, np.s_[iy0:iy1])
+                self.stokesQ_db.write_direct(bufQ, rows, np.s_[iy0:iy1])
+                self.stokesU_db.write_direct(bufU, rows, np.s_[iy0:iy1])
+                self.stokesV_db.write_direct(bufV, rows, np.s_[iy0:iy1])
+                if (interpolate_model):
+                    self.model_db.write_direct(bufModel, rows, np.s_[iy0:iy1])
+                    self.f_model_out.flush()
+                self.f_stokes_out.flush()
+
+            pbar.close()
+        finally:
+            self.f_stokes_out.close()
+            if (interpolate_model):
+                self.f_model_out.close()
+                                            
+
+    def write_collective(self, dset, start, data):
+        """
+        Write a block of a dataset collectively. All ranks have to call it the same number of times,
+        passing None when they have nothing to write.
 
-            tmp = np.fromfile(self.model.By_file, dtype = np.float32)
-            tmpa = tmp.reshape(self.model.model_shape)
-            self.By = tmpa.transpose(self.model.az, self.model.ay, self.model.ax)
+        Parameters
+        ----------
+        dset : h5py.Dataset
+            Dataset opened with the MPI-IO driver
+        start : tuple
+            Offset of the block in the dataset
+        data : array
+            Block to be written, or None
 
-            tmp = np.fromfile(self.model.Bz_file, dtype = np.float32)
-            tmpa = tmp.reshape(self.model.model_shape)
-            self.Bz = tmpa.transpose(self.model.az, self.model.ay, self.model.ax)
+        Returns
+        -------
+        None
+        """
+        fspace = dset.id.get_space()
+        if (data is None):
+            fspace.select_none()
+            mspace = h5py.h5s.create_simple((1,))
+            mspace.select_none()
+            data = np.zeros(1, dtype=dset.dtype)
+        else:
+            data = np.ascontiguousarray(data, dtype=dset.dtype)
+            fspace.select_hyperslab(tuple(start), data.shape)
+            mspace = h5py.h5s.create_simple(data.shape)
 
-            tmp = np.fromfile(self.model.tau_file, dtype = np.float32)
-            tmpa = tmp.reshape(self.model.model_shape)
-            self.tau500 = tmpa.transpose(self.model.az, self.model.ay, self.model.ax)
+        dset.id.write(mspace, fspace, data, dxpl=self.dxpl)
 
-            tmp = np.fromfile(self.model.ne_file, dtype = np.float32)
-            tmpa = tmp.reshape(self.model.model_shape)
-            self.ne = tmpa.transpose(self.model.az, self.model.ay, self.model.ax)
+    def mpi_collective_work(self, rangex, rangey):
+        """
+        Do the synthesis on all ranks, each one writing its own pixels to the output files
+        with collective parallel HDF5
 
-            self.n_pixels = self.model.nx * self.model.ny
+        Parameters
+        ----------
+        rangex, rangey : list
+            Limits of the region to synthesize along each axis, or None for the full cube
 
-        self.f_stokes_out = h5py.File(self.model.output_file, 'w')
-        self.stokesI_db = self.f_stokes_out.create_dataset('I', (self.model.ny, self.model.nx, self.model.n_lambda_sir), chunks=(64, 64, self.model.n_lambda_sir))
-        self.stokesQ_db = self.f_stokes_out.create_dataset('Q', (self.model.ny, self.model.nx, self.model.n_lambda_sir), chunks=(64, 64, self.model.n_lambda_sir))
-        self.stokesU_db = self.f_stokes_out.create_dataset('U', (self.model.ny, self.model.nx, self.model.n_lambda_sir), chunks=(64, 64, self.model.n_lambda_sir))
-        self.stokesV_db = self.f_stokes_out.create_dataset('V', (self.model.ny, self.model.nx, self.model.n_lambda_sir), chunks=(64, 64, self.model.n_lambda_sir))
-        self.lambda_db = self.f_stokes_out.create_dataset('lambda', (self.model.n_lambda_sir,))
-        self.f_stokes_out.attrs.create("lambda_zeropoint", self.model.lambda_zeropoint)
+        Returns
+        -------
+        None
+        """
+
+        # The cubes are shared by all ranks of a node instead of being copied by each of them
+        self.windows = []
+        if (self.model.atmosphere_type == 'MURAM'):
+            self._load_muram(shared=True)
+
+        if (rangex is not None):
+            x = np.arange(rangex[0], rangex[1])
+        else:
+            x = np.arange(self.model.nx)
+
+        if (rangey is not None):
+            y = np.arange(rangey[0], rangey[1])
+        else:
+            y = np.arange(self.model.ny)
+
+        self.n_pixels = len(x) * len(y)
+
+        self.dxpl = h5py.h5p.create(h5py.h5p.DATASET_XFER)
+        self.dxpl.set_dxpl_mpio(h5py.h5fd.MPIO_COLLECTIVE)
+
+        # Files and datasets are created collectively by all ranks
+        chunks = self.chunk_shape(self.size)
+        self.f_stokes_out = self.open_stokes_file(chunks, driver='mpio', comm=self.comm)
+        self.create_stokes_datasets(chunks)
 
         # If we want to extract a model sampled at selected taus
         interpolate_model = False
         if (self.model.interpolated_model_filename is not None):
-            self.f_model_out = h5py.File(self.model.interpolated_model_filename, 'w')
-            self.model_db = self.f_model_out.create_dataset('model', (self.model.ny, self.model.nx, 7, self.model.n_tau))
+            self.f_model_out = h5py.File(self.model.interpolated_model_filename, 'w', driver='mpio', comm=self.comm)
+            self.model_db = self.f_model_out.create_dataset('model', (7, self.model.ny, self.model.nx, self.model.n_tau), dtype=np.float32)
             interpolate_model = True
 
-        
-        for iy in trange(self.model.ny, desc='y'):
-            for ix in trange(self.model.nx, desc='x'):
+        # Split the region in tiles aligned with the HDF5 chunks, so that every chunk is written by a single rank,
+        # and deal them out round-robin, so that costly regions of the cube are spread over all ranks
+        tiles = []
+        for by in range(y[0] // chunks[0], y[-1] // chunks[0] + 1):
+            for bx in range(x[0] // chunks[1], x[-1] // chunks[1] + 1):
+                tiles.append((max(by * chunks[0], y[0]), min((by + 1) * chunks[0], y[-1] + 1), 
+                    max(bx * chunks[1], x[0]), min((bx + 1) * chunks[1], x[-1] + 1)))
 
-                if (self.model.vz_type == 'vz'):
-                    vz = self.vz[:,iy,ix]
-                else:
-                    vz = self.vz[:,iy,ix] / self.rho[:,iy,ix]
+        my_tiles = tiles[self.rank::self.size]
+        n_rounds = (len(tiles) + self.size - 1) // self.size
 
-                if (interpolate_model):
-                    stokes, model = self.model.synth(self.T[:,iy,ix].astype('float64'), self.P[:,iy,ix].astype('float64'), 
-                        self.rho[:,iy,ix].astype('float64'), vz.astype('float64'), self.Bx[:,iy,ix].astype('float64'), 
-                        self.By[:,iy,ix].astype('float64'), self.Bz[:,iy,ix].astype('float64'), self.tau500[:,iy,ix].astype('float64'), self.ne[:,iy,ix].astype('float64'), interpolate_model=interpolate_model)
-                    self.model_db[iy,ix,:,:] = model
+        if (self.rank == 0):
+            self.logger.info("Starting calculation with {0} ranks and {1} tiles".format(self.size, len(tiles)))
 
+        # Every round all ranks write one tile collectively, ranks without tiles left take part with empty writes
+        for i in trange(n_rounds, ncols=140, disable=(self.rank != 0)):
+            if (i < len(my_tiles)):
+                iy0, iy1, ix0, ix1 = my_tiles[i]
+                ny_tile, nx_tile = iy1 - iy0, ix1 - ix0
+
+                T, P, rho, vz, Bx, By, Bz, tau500, Ne = [f.reshape(ny_tile * nx_tile, -1) for f in self.load_tile(iy0, iy1, ix0, ix1)]
+
+                if (interpolate_model):
+                    stokes, model = self.model.synth2d(T, P, rho, vz, Bx, By, Bz, tau500, Ne, interpolate_model=interpolate_model)
+                    model = model.reshape(7, ny_tile, nx_tile, self.model.n_tau)
                 else:
-                    stokes = self.model.synth(self.T[:,iy,ix].astype('float64'), self.P[:,iy,ix].astype('float64'), 
-                        self.rho[:,iy,ix].astype('float64'), self.vz[:,iy,ix].astype('float64'), self.Bx[:,iy,ix].astype('float64'), 
-                        self.By[:,iy,ix].astype('float64'), self.Bz[:,iy,ix].astype('float64'), self.tau500[:,iy,ix].astype('float64'), self.ne[:,iy,ix].astype('float64'), interpolate_model=interpolate_model)
+                    stokes = self.model.synth2d(T, P, rho, vz, Bx, By, Bz, tau500, Ne, interpolate_model=None)
 
-                self.stokesI_db[iy,ix,:] = stokes[1,:]
-                self.stokesQ_db[iy,ix,:] = stokes[2,:]
-                self.stokesU_db[iy,ix,:] = stokes[3,:]
-                self.stokesV_db[iy,ix,:] = stokes[4,:]
+                stokes = stokes.reshape(5, ny_tile, nx_tile, self.model.n_lambda_sir)
 
-        self.lambda_db[:] = stokes[0,:]
+                self.write_collective(self.stokesI_db, (iy0, ix0, 0), stokes[1])
+                self.write_collective(self.stokesQ_db, (iy0, ix0, 0), stokes[2])
+                self.write_collective(self.stokesU_db, (iy0, ix0, 0), stokes[3])
+                self.write_collective(self.stokesV_db, (iy0, ix0, 0), stokes[4])
+                if (interpolate_model):
+                    self.write_collective(self.model_db, (0, iy0, ix0, 0), model)
+                del stokes
+            else:
+                self.write_collective(self.stokesI_db, None, None)
+                self.write_collective(self.stokesQ_db, None, None)
+                self.write_collective(self.stokesU_db, None, None)
+                self.write_collective(self.stokesV_db, None, None)
+                if (interpolate_model):
+                    self.write_collective(self.model_db, None, None)
 
         self.f_stokes_out.close()
-        self.f_model_out.close()
-                                            
+        if (interpolate_model):
+            self.f_model_out.close()
+
+        self._free_shared_fields()
 
     def mpi_master_work(self, rangex, rangey):
         """
@@ -196,42 +508,7 @@ class Iterator(object):
         
 
         if (self.model.atmosphere_type == 'MURAM'):
-            tmp = np.fromfile(self.model.T_file, dtype = np.float32)
-            tmpa = tmp.reshape(self.model.model_shape)
-            self.T = tmpa.transpose(self.model.az, self.model.ay, self.model.ax)
-
-            tmp = np.fromfile(self.model.P_file, dtype = np.float32)
-            tmpa = tmp.reshape(self.model.model_shape)
-            self.P = tmpa.transpose(self.model.az, self.model.ay, self.model.ax)
-
-            tmp = np.fromfile(self.model.rho_file, dtype = np.float32)
-            tmpa = tmp.reshape(self.model.model_shape)
-            self.rho = tmpa.transpose(self.model.az, self.model.ay, self.model.ax)
-
-            tmp = np.fromfile(self.model.vz_file, dtype = np.float32)
-            tmpa = tmp.reshape(self.model.model_shape)
-            self.vz = tmpa.transpose(self.model.az, self.model.ay, self.model.ax)
-
-            tmp = np.fromfile(self.model.Bx_file, dtype = np.float32)
-            tmpa = tmp.reshape(self.model.model_shape)
-            self.Bx = tmpa.transpose(self.model.az, self.model.ay, self.model.ax)
-
-            tmp = np.fromfile(self.model.By_file, dtype = np.float32)
-            tmpa = tmp.reshape(self.model.model_shape)
-            self.By = tmpa.transpose(self.model.az, self.model.ay, self.model.ax)
-
-            tmp = np.fromfile(self.model.Bz_file, dtype = np.float32)
-            tmpa = tmp.reshape(self.model.model_shape)
-            self.Bz = tmpa.transpose(self.model.az, self.model.ay, self.model.ax)
-
-            tmp = np.fromfile(self.model.tau_file, dtype = np.float32)
-            tmpa = tmp.reshape(self.model.model_shape)
-            self.tau500 = tmpa.transpose(self.model.az, self.model.ay, self.model.ax)
-
-            tmp = np.fromfile(self.model.ne_file, dtype = np.float32)
-            tmpa = tmp.reshape(self.model.model_shape)
-            self.ne = tmpa.transpose(self.model.az, self.model.ay, self.model.ax)
-
+            self._load_muram()
 
         if (rangex is not None):
             x = np.arange(rangex[0], rangex[1])
@@ -253,94 +530,234 @@ class Iterator(object):
         
         divX = np.array_split(X, self.n_batches)
         divY = np.array_split(Y, self.n_batches)
+
+        # Flat pixel indices of every batch into the (y*x, z) views of the fields, so that
+        # packing a batch is a single gather along the leading axis
+        divP = np.array_split(Y * self.T.shape[1] + X, self.n_batches)
+        self.fields = [f.reshape(-1, f.shape[2]) for f in (self.T, self.P, self.rho, self.vz, self.Bx, self.By, self.Bz, self.tau500, self.ne)]
     
-        self.f_stokes_out = h5py.File(self.model.output_file, 'w')
-        self.stokesI_db = self.f_stokes_out.create_dataset('I', (self.model.ny, self.model.nx, self.model.n_lambda_sir), chunks=(64, 64, self.model.n_lambda_sir))
-        self.stokesQ_db = self.f_stokes_out.create_dataset('Q', (self.model.ny, self.model.nx, self.model.n_lambda_sir), chunks=(64, 64, self.model.n_lambda_sir))
-        self.stokesU_db = self.f_stokes_out.create_dataset('U', (self.model.ny, self.model.nx, self.model.n_lambda_sir), chunks=(64, 64, self.model.n_lambda_sir))
-        self.stokesV_db = self.f_stokes_out.create_dataset('V', (self.model.ny, self.model.nx, self.model.n_lambda_sir), chunks=(64, 64, self.model.n_lambda_sir))
-        self.lambda_db = self.f_stokes_out.create_dataset('lambda', (self.model.n_lambda_sir,))
-        self.f_stokes_out.attrs.create("lambda_zeropoint", self.model.lambda_zeropoint)
+        chunks = self.chunk_shape(self.size - 1)
+        self.f_stokes_out = self.open_stokes_file(chunks)
+        self.create_stokes_datasets(chunks)
 
         # If we want to extract a model sampled at selected taus
         interpolate_model = False
         if (self.model.interpolated_model_filename is not None):
             self.f_model_out = h5py.File(self.model.interpolated_model_filename, 'w')
-            self.model_db = self.f_model_out.create_dataset('model', (7, self.model.ny, self.model.nx, self.model.n_tau))
+            self.model_db = self.f_model_out.create_dataset('model', (7, self.model.ny, self.model.nx, self.model.n_tau), dtype=np.float32)
             interpolate_model = True
                 
         
+        # Results are staged per row of chunks until all its pixels have been received
+        n_rows = chunks[0]
+        pending = {}
+
         # Loop over all pixels doing the synthesis/inversion and saving the results
         task_index = 0
         num_workers = self.size - 1
-        closed_workers = 0
         self.last_received = 0
         self.last_sent = 0
 
+        # Each worker returns its results into its own buffer through a persistent non-blocking receive,
+        # so that transfers proceed while the master is writing to disk
+        max_batch = max([len(ix) for ix in divX])
+        n_stokes = 5 * max_batch * self.model.n_lambda_sir
+        n_model = 7 * max_batch * self.model.n_tau if interpolate_model else 0
+        recv_bufs = [np.empty(n_stokes + n_model, dtype=np.float32) for i in range(num_workers)]
+        requests = [self.comm.Recv_init([recv_bufs[i], MPI.FLOAT], source=i+1, tag=tags.STOKES) for i in range(num_workers)]
+        assigned = [None] * num_workers
+
         self.logger.info("Starting calculation with {0} workers and {1} batches".format(num_workers, self.n_batches))
 
-        with tqdm(total=self.n_batches, ncols=140) as pbar:            
-            while (closed_workers < num_workers):
-                data_received = self.comm.recv(source=MPI.ANY_SOURCE, tag=MPI.ANY_TAG, status=self.status)
-                source = self.status.Get_source()
-                tag = self.status.Get_tag()
-
-                if tag == tags.READY:
-                    # Worker is ready, send a task
-                    if (task_index < self.n_batches):
-
-                        ix = divX[task_index]
-                        iy = divY[task_index]
-                        data_to_send = {'index': task_index, 'indX': ix, 'indY': iy, 'interpolate': interpolate_model}
-
-                        if (self.model.vz_type == 'vz'):
-                            vz = self.vz[:,iy,ix]
-                        else:
-                            vz = self.vz[:,iy,ix] / self.rho[:,iy,ix]
-                        
-                        data_to_send['model'] = [self.T[:,iy,ix].astype('float64'), self.P[:,iy,ix].astype('float64'), 
-                            self.rho[:,iy,ix].astype('float64'), vz.astype('float64'), self.Bx[:,iy,ix].astype('float64'), 
-                            self.By[:,iy,ix].astype('float64'), self.Bz[:,iy,ix].astype('float64'), self.tau500[:,iy,ix].astype('float64'), self.ne[:,iy,ix].astype('float64')]
-                    
-                        self.comm.send(data_to_send, dest=source, tag=tags.START)
-                    
-                        task_index += 1
-                        pbar.update(1)
-                        self.last_sent = '{0} to {1}'.format(task_index, source)
-                        pbar.set_postfix(sent=self.last_sent, received=self.last_received)
+        with tqdm(total=self.n_batches, ncols=140) as pbar:
 
-                    else:
-                        self.comm.send(None, dest=source, tag=tags.EXIT)
-                
-                elif tag == tags.DONE:
-                    index = data_received['index']
-                    stokes = data_received['stokes']
-                    indX = data_received['indX']
-                    indY = data_received['indY']
+            for i in range(num_workers):
+                if (task_index < self.n_batches):
+                    self.send_task(task_index, i+1, divP)
+                    requests[i].Start()
+                    assigned[i] = task_index
+                    task_index += 1
+                    pbar.update(1)
+                    self.last_sent = '{0} to {1}'.format(task_index, i+1)
+                else:
+                    self.comm.send(None, dest=i+1, tag=tags.EXIT)
 
+            pbar.set_postfix(sent=self.last_sent, received=self.last_received)
+
+            while True:
+                i = MPI.Request.Waitany(requests)
+                if (i == MPI.UNDEFINED):
+                    break
+
+                source = i + 1
+                index = assigned[i]
+                indX = divX[index]
+                indY = divY[index]
+
+                n = len(indX)
+                stokes = recv_bufs[i][:5*n*self.model.n_lambda_sir].reshape(5, n, self.model.n_lambda_sir)
+                model = None
+                if (interpolate_model):
+                    model = recv_bufs[i][5*n*self.model.n_lambda_sir:5*n*self.model.n_lambda_sir+7*n*self.model.n_tau].reshape(7, n, self.model.n_tau)
+
+                complete = self.stage_results(pending, indX, indY, stokes, model, n_rows, y, x, interpolate_model)
+
+                # Hand out the next task before writing, so that the worker computes while the master does the I/O
+                if (task_index < self.n_batches):
+                    self.send_task(task_index, source, divP)
+                    requests[i].Start()
+                    assigned[i] = task_index
+                    task_index += 1
+                    pbar.update(1)
+                    self.last_sent = '{0} to {1}'.format(task_index, source)
+                else:
+                    self.comm.send(None, dest=source, tag=tags.EXIT)
+
+                for b in complete:
+                    self.flush_row_buffer(pending.pop(b), x, interpolate_model)
+
+                self.last_received = '{0} from {1}'.format(index, source)
+                pbar.set_postfix(sent=self.last_sent, received=self.last_received)
+
+        for request in requests:
+            request.Free()
 
-                    if (interpolate_model):
-                        model = data_received['model']
-                        for i in range(len(indX)):
-                            self.model_db[:,indY[i],indX[i],:] = model[:,i,:]
-                    
-                    for i in range(len(indX)):
-                        self.stokesI_db[indY[i],indX[i],:] = stokes[1,i,:]
-                        self.stokesQ_db[indY[i],indX[i],:] = stokes[2,i,:]
-                        self.stokesU_db[indY[i],indX[i],:] = stokes[3,i,:]
-                        self.stokesV_db[indY[i],indX[i],:] = stokes[4,i,:]
-                                                    
-                    self.last_received = '{0} from {1}'.format(index, source)
-                    pbar.set_postfix(sent=self.last_sent, received=self.last_received)
-
-                elif tag == tags.EXIT:                    
-                    closed_workers += 1
-
-        self.lambda_db[:] = stokes[0,0,:]
         self.f_stokes_out.close()
         if (interpolate_model):
             self.f_model_out.close()
 
+    def send_task(self, task_index, dest, divP):
+        """
+        Send one batch of pixels to a worker. The batch is a single typed message, whose size tells
+        the worker the number of pixels.
+
+        Parameters
+        ----------
+        task_index : int
+            Index of the batch
+        dest : int
+            Rank of the worker
+        divP : list
+            Flat pixel indices of all batches
+
+        Returns
+        -------
+        None
+        """
+        ip = divP[task_index]
+
+        # Pack the nine fields in a single buffer that is sent without pickling
+        model = np.empty((9, len(ip), self.T.shape[2]), dtype=np.float64)
+        for i, field in enumerate(self.fields):
+            model[i] = field.take(ip, axis=0)
+
+        self.comm.Send([model, MPI.DOUBLE], dest=dest, tag=tags.MODEL)
+
+    def stage_results(self, pending, indX, indY, stokes, model, n_rows, y, x, interpolate_model):
+        """
+        Copy the results of one batch into the buffers of their rows of chunks
+
+        Parameters
+        ----------
+        pending : dict
+            Buffers of the rows of chunks not yet written, indexed by row of chunks
+        indX, indY : array
+            Pixels of the batch
+        stokes : array
+            Stokes parameters of the batch
+        model : array
+            Interpolated model of the batch, or None
+        n_rows : int
+            Number of rows of pixels in a row of chunks
+        y, x : array
+            Pixels to be synthesized along each axis
+        interpolate_model : bool
+            Whether the interpolated model is also buffered
+
+        Returns
+        -------
+        list
+            Rows of chunks that are complete and can be written
+        """
+        complete = []
+        block = indY // n_rows
+        for b in np.unique(block):
+            if (b not in pending):
+                pending[b] = self.new_row_buffer(b, n_rows, y, x, interpolate_model)
+            buf = pending[b]
+            sel = block == b
+            rows = indY[sel] - buf['y0']
+            cols = indX[sel] - x[0]
+            buf['I'][rows,cols,:] = stokes[1,sel,:]
+            buf['Q'][rows,cols,:] = stokes[2,sel,:]
+            buf['U'][rows,cols,:] = stokes[3,sel,:]
+            buf['V'][rows,cols,:] = stokes[4,sel,:]
+            if (interpolate_model):
+                buf['model'][:,rows,cols,:] = model[:,sel,:]
+            buf['count'] += np.count_nonzero(sel)
+
+            if (buf['count'] == buf['I'].shape[0] * buf['I'].shape[1]):
+                complete.append(b)
+
+        return complete
+
+    def new_row_buffer(self, block, n_rows, y, x, interpolate_model):
+        """
+        Allocate the in-memory buffer for one row of HDF5 chunks
+
+        Parameters
+        ----------
+        block : int
+            Index of the row of chunks
+        n_rows : int
+            Number of rows of pixels in a row of chunks
+        y, x : array
+            Pixels to be synthesized along each axis
+        interpolate_model : bool
+            Whether the interpolated model is also buffered
+
+        Returns
+        -------
+        dict
+            Buffers for the Stokes parameters and the model
+        """
+        y0 = max(block * n_rows, y[0])
+        y1 = min((block + 1) * n_rows, y[-1] + 1)
+        buf = {'y0': y0, 'y1': y1, 'count': 0}
+        for k in ['I', 'Q', 'U', 'V']:
+            buf[k] = np.empty((y1 - y0, len(x), self.model.n_lambda_sir), dtype=np.float32)
+        if (interpolate_model):
+            buf['model'] = np.empty((7, y1 - y0, len(x), self.model.n_tau), dtype=np.float32)
+        return buf
+
+    def flush_row_buffer(self, buf, x, interpolate_model):
+        """
+        Write one row of HDF5 chunks to the output files
+
+        Parameters
+        ----------
+        buf : dict
+            Buffers returned by new_row_buffer
+        x : array
+            Pixels to be synthesized along the x axis
+        interpolate_model : bool
+            Whether the interpolated model is also written
+
+        Returns
+        -------
+        None
+        """
+        y0, y1 = buf['y0'], buf['y1']
+        x0, x1 = x[0], x[-1] + 1
+        self.stokesI_db.write_direct(buf['I'], None, np.s_[y0:y1,x0:x1])
+        self.stokesQ_db.write_direct(buf['Q'], None, np.s_[y0:y1,x0:x1])
+        self.stokesU_db.write_direct(buf['U'], None, np.s_[y0:y1,x0:x1])
+        self.stokesV_db.write_direct(buf['V'], None, np.s_[y0:y1,x0:x1])
+        if (interpolate_model):
+            self.model_db.write_direct(buf['model'], None, np.s_[:,y0:y1,x0:x1])
+            self.f_model_out.flush()
+        self.f_stokes_out.flush()
+
     def mpi_agents_work(self):
         """
         MPI agents work
@@ -354,36 +771,36 @@ class Iterator(object):
         None
         """
         
+        nz = self.model.model_shape[self.model.az]
+        interpolate_model = (self.model.interpolated_model_filename is not None)
+
         while True:
-            self.comm.send(None, dest=0, tag=tags.READY)
-            data_received = self.comm.recv(source=0, tag=MPI.ANY_TAG, status=self.status)
+            # Batches arrive as a bare buffer of doubles, so its size is taken from the pending message
+            self.comm.Probe(source=0, tag=MPI.ANY_TAG, status=self.status)
 
             tag = self.status.Get_tag()
             
-            if tag == tags.START:                                
-                task_index = data_received['index']
-                indX = data_received['indX']
-                indY = data_received['indY']
-                interpolate_model = data_received['interpolate']
+            if tag == tags.MODEL:
+                n = self.status.Get_count(MPI.DOUBLE) // (9 * nz)
 
-                data_to_send = {'index': task_index, 'indX': indX, 'indY': indY}
+                model_in = np.empty((9, n, nz), dtype=np.float64)
+                self.comm.Recv([model_in, MPI.DOUBLE], source=0, tag=tags.MODEL)
 
-                T, P, rho, vz, Bx, By, Bz, tau500, Ne = data_received['model']
+                T, P, rho, vz, Bx, By, Bz, tau500, Ne = model_in
 
+                # The Stokes parameters and the model are returned in a single buffer
                 if (interpolate_model):
                     stokes, model = self.model.synth2d(T, P, rho, vz, Bx, By, Bz, tau500, Ne, interpolate_model=interpolate_model)
-                    data_to_send['model'] = model
+                    data_to_send = np.concatenate([stokes.ravel(), model.ravel()]).astype(np.float32)
                 else:
                     stokes = self.model.synth2d(T, P, rho, vz, Bx, By, Bz, tau500, Ne, interpolate_model=None)
+                    data_to_send = stokes.ravel().astype(np.float32)
 
-                data_to_send['stokes'] = stokes
-                
-                self.comm.send(data_to_send, dest=0, tag=tags.DONE)
+                self.comm.Send([data_to_send, MPI.FLOAT], dest=0, tag=tags.STOKES)
             elif tag == tags.EXIT:
+                self.comm.recv(source=0, tag=tags.EXIT)
                 break
 
-        self.comm.send(None, dest=0, tag=tags.EXIT)           
-
     def run_all_pixels(self, rangex=None, rangey=None):
         """
         Run synthesis/inversion for all pixels
@@ -397,7 +814,9 @@ class Iterator(object):
         None
         """
         if (self.use_mpi):
-            if (self.rank == 0):
+            if (_parallel_hdf5):
+                self.mpi_collective_work(rangex=rangex, rangey=rangey)
+            elif (self.rank == 0):
                 self.mpi_master_work(rangex=rangex, rangey=rangey)
             else:
                 self.mpi_agents_work()